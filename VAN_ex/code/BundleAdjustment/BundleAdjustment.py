@@ -1,5 +1,6 @@
 import os
 import pickle
+from concurrent.futures import ProcessPoolExecutor
 
 import gtsam
 import numpy as np
@@ -12,6 +13,9 @@ from VAN_ex.code.utils import utils, projection_utils
 
 FRAC = 0.6
 
+# The tracks database and transformations of the worker processes of BundleAdjustment.solve
+worker_data = {}
+
 
 def save_ba(ba, path):
     """
@@ -31,6 +35,26 @@ def load_ba(path):
     return ba
 
 
+def init_window_worker(tracks_db, T_arr):
+    """
+    Keep the tracks database and the transformations in the worker process, so they are passed
+     once per worker and not with every bundle window.
+    """
+    worker_data['tracks_db'] = tracks_db
+    worker_data['T_arr'] = T_arr
+
+
+def solve_window(bundle_window):
+    """
+    Build the graph of a bundle window and optimize it, in a worker process.
+    :param bundle_window: Bundle window to solve.
+    :return: The optimized bundle window.
+    """
+    bundle_window.create_graph_v2(worker_data['T_arr'], worker_data['tracks_db'])
+    bundle_window.optimize()
+    return bundle_window
+
+
 class BundleAdjustment:
 
     def __init__(self, tracks_db: TracksDB, T_arr: np.ndarray):
@@ -82,14 +106,20 @@ class BundleAdjustment:
         # print('First 10 Keyframes: ', self.keyframes[:10])
 
     @utils.measure_time
-    def solve(self):
+    def solve(self, workers=None):
+        """
+        Solve all the bundle windows between the keyframes. The windows are independent of each other,
+         so they are optimized in parallel (workers=None uses all the cores).
+        """
         print("solving bundle adjustment...")
-        self.bundle_windows = self.create_bundle_windows(self.keyframes)
+        bundle_windows = self.create_bundle_windows(self.keyframes)
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_window_worker,
+                                 initargs=(self.tracks_db, self.T_arr)) as executor:
+            self.bundle_windows = list(tqdm(executor.map(solve_window, bundle_windows), total=len(bundle_windows)))
+
         cameras = [gtsam.Pose3()]
         points = []
-        for bundle_window in tqdm(self.bundle_windows):
-            bundle_window.create_graph_v2(self.T_arr, self.tracks_db)
-            bundle_window.optimize()
+        for bundle_window in self.bundle_windows:
             cameras.append(bundle_window.get_from_optimized(obj='camera_p3d'))
             points.append(bundle_window.get_from_optimized(obj='landmarks'))
 
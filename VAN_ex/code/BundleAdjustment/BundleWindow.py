@@ -7,6 +7,18 @@ from VAN_ex.code.utils import projection_utils, utils
 
 MAX_Z = 200
 MIN_Y = -10
+K = utils.create_gtsam_K()  # gtsam stereo calibration, shared by all the stereo cameras and factors
+STEREO_NOISE = gtsam.noiseModel.Isotropic.Sigma(3, 1.0)  # Shared by all the stereo factors
+
+
+def create_lm_params():
+    """
+    Levenberg-Marquardt parameters for a bundle window. The METIS ordering keeps the fill-in of the
+     factorization small on the camera-landmark structure of a bundle.
+    """
+    params = gtsam.LevenbergMarquardtParams()
+    params.setOrderingType('METIS')
+    return params
 
 
 class Bundle:
@@ -44,26 +56,27 @@ class Bundle:
             return self.graph.error(self.result)
 
     def optimize(self):
-        optimizer = gtsam.LevenbergMarquardtOptimizer(self.graph, self.initial_estimates)
+        optimizer = gtsam.LevenbergMarquardtOptimizer(self.graph, self.initial_estimates, create_lm_params())
         self.result = optimizer.optimize()
         return self.result
 
     def create_graph_v2(self, T_arr, tracks_db: TracksDB):
-        K = utils.create_gtsam_K()
         base_camera = projection_utils.convert_ext_mat_to_world(T_arr[self.frames_idxs[0]])
 
+        # Poses of all the cameras of the bundle window, converted in one batched call
+        window_ext_mats = projection_utils.composite_transformations(base_camera, T_arr[self.frames_idxs])
+        window_poses = projection_utils.convert_ext_mat_to_world(window_ext_mats)
+
         tracks_in_frames = set()
 
         # Create a pose for each camera in the bundle window
-        for frame_id in self.frames_idxs:
+        for frame_id, pose_mat in zip(self.frames_idxs, window_poses):
             tracks_in_frames.update(tracks_db.get_track_ids(frame_id))
 
             symbol = gtsam.symbol('c', frame_id)
             self.cameras.append(symbol)
 
-            ext_mat = T_arr[frame_id]
-            cur_ext_mat = projection_utils.composite_transformations(base_camera, ext_mat)
-            pose = gtsam.Pose3(projection_utils.convert_ext_mat_to_world(cur_ext_mat))
+            pose = gtsam.Pose3(pose_mat)
             self.initial_estimates.insert(symbol, pose)
 
             # Add a prior factor just for first camera pose
@@ -74,32 +87,31 @@ class Bundle:
                 self.prior_factor = factor
                 self.graph.add(factor)
 
+        # create a gtsam camera for the last frame of the bundle window
+        last_stereo = gtsam.StereoCamera(pose, K)
+        cam_symbols = dict(zip(self.frames_idxs, self.cameras))  # Built once, shared by all the tracks' factors
+
         tracks_in_frames = list(tracks_in_frames)
         for track_id in tracks_in_frames:
-            # create a gtsam camera for the last frame of the bundle window
-            last_stereo = gtsam.StereoCamera(pose, K)
             first_frame = max(self.frames_idxs[0], tracks_db.tracks[track_id].get_frame_ids()[0])
             last_frame = min(self.frames_idxs[-1], tracks_db.tracks[track_id].get_frame_ids()[-1])
             if first_frame > last_frame:
                 continue
             track = tracks_db.tracks[track_id]
             self.extract_factors_to_gtsam(track=track, first_frame=first_frame, last_frame=last_frame,
-                                          gtsam_frame_to_triangulate_from=last_stereo, K=K)
-
-    def extract_factors_to_gtsam(self, track: Track, first_frame, last_frame, gtsam_frame_to_triangulate_from, K):
-        left_kp_all, right_kp_all = track.get_left_kp(), track.get_right_kp()
+                                          gtsam_frame_to_triangulate_from=last_stereo, K=K, cam_symbols=cam_symbols)
 
-        # get the locations of the track only inside the bundle window
-        left_locations = {frame_id: kp for frame_id, kp in left_kp_all.items() if first_frame <= frame_id <= last_frame}
-        right_locations = {frame_id: kp for frame_id, kp in right_kp_all.items() if
-                           first_frame <= frame_id <= last_frame}
-
-        last_left_kp = left_locations[last_frame]
-        last_right_kp = right_locations[last_frame]
+    def extract_factors_to_gtsam(self, track: Track, first_frame, last_frame, gtsam_frame_to_triangulate_from, K,
+                                 cam_symbols):
+        # (xl, xr, y) measurements of the track inside the bundle window, taken as one slice of its rows.
+        # A loop window has only its two frames, and so do the loop tracks, so the frames range is enough.
+        track_frames = np.asarray(track.get_frame_ids())
+        in_window = (first_frame <= track_frames) & (track_frames <= last_frame)
+        window_frames = track_frames[in_window].tolist()
+        measurements = track.feature_locations()[in_window].tolist()
 
         # coords for triangulation
-        xl, xr, y = last_left_kp[0], last_right_kp[0], last_left_kp[1]
-        point = gtsam.StereoPoint2(xl, xr, y)
+        point = gtsam.StereoPoint2(*measurements[-1])
         p3d = gtsam_frame_to_triangulate_from.backproject(point)
 
         # Add the point to the graph and to the list of points only if it's z is not too big
@@ -116,19 +128,10 @@ class Bundle:
         self.points.append(symbol)
         self.initial_estimates.insert(symbol, p3d)
 
-        for frame_id in range(first_frame, last_frame + 1):
-            if frame_id not in self.frames_idxs:
-                # this is for the loop tracks, which only have two frames in the bundle window
-                continue
-
-            xl, xr, y = left_locations[frame_id][0], right_locations[frame_id][0], left_locations[frame_id][1]
-            inner_point = gtsam.StereoPoint2(xl, xr, y)
-
-            # Create a stereo factor
-            projection_cov = gtsam.noiseModel.Isotropic.Sigma(3, 1.0)
-            factor = gtsam.GenericStereoFactor3D(inner_point, projection_cov, gtsam.symbol('c', frame_id),
-                                                 symbol, K)
-            # Add the factor to the graph
+        for frame_id, (xl, xr, y) in zip(window_frames, measurements):
+            # Create a stereo factor and add it to the graph
+            factor = gtsam.GenericStereoFactor3D(gtsam.StereoPoint2(xl, xr, y), STEREO_NOISE,
+                                                 cam_symbols[frame_id], symbol, K)
             self.graph.add(factor)
 
     def get_from_optimized(self, obj: str):
@@ -1,3 +1,9 @@
+import numpy as np
+
+# Column layout of Track.obs
+FRAME_COL, XL_COL, YL_COL, XR_COL, YR_COL = range(5)
+
+
 class Track:
     """
     A class that represents a track.
@@ -11,19 +17,36 @@ class Track:
         Initialize a track.
         :param track_id: Track ID.
         :param frame_ids: Frame IDs.
-        :param kp: list of tuples of key points in both images, for each frame.
+        :param kp: dictionary of tuples of key points in both images, for each frame.
         """
         self.track_id = track_id
-        self.frame_ids = frame_ids
-        self.kp = kp  # one tuple of key points for each frame
+        self.frame_ids = []
+        self.frame_rows = {}  # frame_id -> row in obs, for O(1) lookups
+        # one (frame_id, xl, yl, xr, yr) row for each frame, kept in a single contiguous array
+        self.obs = np.empty((0, 5), dtype=np.float32)
+        for frame_id in frame_ids:
+            self.add_frame(frame_id, kp[frame_id])
 
     def __str__(self):
         return f"Track ID: {self.track_id}, Frame IDs: {self.frame_ids}, " \
-               f"Key-points: {len(self.kp)}, length: {len(self.frame_ids)}"
+               f"Key-points: {len(self.obs)}, length: {len(self.frame_ids)}"
 
     def __repr__(self):
         return str(self)
 
+    def __setstate__(self, state):
+        kp = state.pop('kp', None)
+        self.__dict__.update(state)
+        # tracks pickled before the array layout stored a dictionary of kp tuples
+        if kp is not None:
+            frame_ids, self.frame_ids = self.frame_ids, []
+            self.frame_rows = {}
+            self.obs = np.empty((0, 5), dtype=np.float32)
+            for frame_id in frame_ids:
+                self.add_frame(frame_id, kp[frame_id])
+        elif 'frame_rows' not in state:
+            self.frame_rows = {frame_id: row for row, frame_id in enumerate(self.frame_ids)}
+
     def get_track_id(self):
         return self.track_id
 
@@ -34,25 +57,52 @@ class Track:
         """
         Add a frame to the track.
         :param frame_id: Frame ID.
-        :param curr_kp: Key-points of the current frame.
-        :param next_kp: Key-points of the next frame.
+        :param next_kp: Key-points (left, right) of the next frame.
         """
-        self.kp[frame_id] = next_kp
+        left_kp, right_kp = next_kp
+        row = np.array([[frame_id, left_kp[0], left_kp[1], right_kp[0], right_kp[1]]], dtype=np.float32)
+        self.obs = np.vstack((self.obs, row))
+        self.frame_rows[frame_id] = len(self.frame_ids)
         self.frame_ids.append(frame_id)
 
+    def get_kp(self, frame_id):
+        """
+        Returns the key-points of the track on the given frame as (xl, yl, xr, yr),
+         or None if the track does not appear on that frame.
+        """
+        row = self.frame_rows.get(frame_id)
+        if row is None:
+            return None
+        return self.obs[row, XL_COL:]
+
+    # get all the kp locations of the track as an (n, 4) array of (xl, yl, xr, yr)
+    def locations(self):
+        return self.obs[:, XL_COL:]
+
+    # get all the left kp locations of the track as an (n, 2) array
+    def left_locations(self):
+        return self.obs[:, XL_COL:YL_COL + 1]
+
+    # get all the right kp locations of the track as an (n, 2) array
+    def right_locations(self):
+        return self.obs[:, XR_COL:YR_COL + 1]
+
     # get all the left kp of the track
     def get_left_kp(self):
-        return {kp: self.kp[kp][0] for kp in self.kp}
+        return dict(zip(self.frame_ids, self.left_locations()))
 
     # get all the right kp of the track as a dictionary
     def get_right_kp(self):
-        return {kp: self.kp[kp][1] for kp in self.kp}
+        return dict(zip(self.frame_ids, self.right_locations()))
 
     def feature_location(self, frame_id):
-        if frame_id in self.frame_ids:
-            xl = self.kp[frame_id][0][0]
-            xr = self.kp[frame_id][1][0]
-            y = self.kp[frame_id][0][1]
+        kp = self.get_kp(frame_id)
+        if kp is not None:
+            xl, y, xr, _ = kp
             return xl, xr, y
         else:
             return None
+
+    # get the (xl, xr, y) feature locations of the track on all its frames as an (n, 3) array
+    def feature_locations(self):
+        return self.obs[:, [XL_COL, XR_COL, YL_COL]]
@@ -1,10 +1,13 @@
 import pickle
+from collections import defaultdict
 
 import numpy as np
 
 from VAN_ex.code.DataBase.Track import Track
 from VAN_ex.code.PreCalcData.paths_to_data import DB_PATH
 
+KP_KEY_DTYPE = np.dtype('V16')  # One stereo key-point: 4 packed float32 coordinates
+
 
 def save_tracks_db(tracks_db, path):
     """
@@ -13,7 +16,7 @@ def save_tracks_db(tracks_db, path):
     :param path: Path to save the pickle file to.
     """
     with open(path, 'wb') as f:
-        pickle.dump(tracks_db, f)
+        pickle.dump(tracks_db, f, protocol=pickle.HIGHEST_PROTOCOL)
 
 
 def load_tracks_db(path=DB_PATH):
@@ -27,6 +30,29 @@ def load_tracks_db(path=DB_PATH):
     return tracks_db
 
 
+def kp_key(kp):
+    """
+    Pack an (n, 4) array of stereo key-points (xl, yl, xr, yr) into n exact keys.
+    The four float32 coordinates of a row are reinterpreted as a single 16 byte value, so two
+     keys are equal exactly when the key-points are equal (coordinates are never negative,
+     so there is no -0.0 / 0.0 ambiguity).
+    :param kp: Key-points array.
+    :return: Array of n keys.
+    """
+    return np.ascontiguousarray(kp, dtype=np.float32).view(KP_KEY_DTYPE).ravel()
+
+
+def match_kps(prev_kp, curr_kp):
+    """
+    Match two (n, 4) arrays of stereo key-points (xl, yl, xr, yr) that were taken on the same frame.
+    :param prev_kp: Key-points already in the tracks.
+    :param curr_kp: Key-points of the new matches.
+    :return: Indexes of the matching rows in prev_kp and in curr_kp.
+    """
+    _, prev_idxs, curr_idxs = np.intersect1d(kp_key(prev_kp), kp_key(curr_kp), return_indices=True)
+    return prev_idxs, curr_idxs
+
+
 class TracksDB:
     """
     A class that represents a database for tracks.
@@ -39,6 +65,8 @@ class TracksDB:
         self.frame_ids = set()
         self.track_ids = []
         self.track_id = 0  # Track ID counter
+        self.frame_to_tracks = defaultdict(set)  # Inverted index: frame_id -> track_ids on that frame
+        self._track_lengths = None  # Cached by get_track_lengths, reset whenever the tracks change
 
     def __str__(self):
         return f"Tracks: {self.tracks}, Frame IDs: {self.frame_ids}, " \
@@ -47,13 +75,41 @@ class TracksDB:
     def __repr__(self):
         return str(self)
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._track_lengths = None
+        # databases pickled before the inverted index existed have to rebuild it
+        if 'frame_to_tracks' not in state:
+            self.frame_to_tracks = defaultdict(set)
+            for track_id in self.track_ids:
+                self.index_track(self.tracks[track_id])
+
+    def index_track(self, track):
+        """
+        Register all the frames of a track in the frame -> tracks index.
+        :param track: Track to index.
+        """
+        for frame_id in track.frame_ids:
+            self.frame_to_tracks[frame_id].add(track.track_id)
+
     def get_track_ids(self, frame_id):
         """
         Get all the track_ids that appear on a given frame_id.
         :param frame_id: Frame ID.
-        :return: Track IDs.
+        :return: Track IDs (a set, should not be modified by the caller).
         """
-        return [track_id for track_id in self.track_ids if frame_id in self.tracks[track_id].frame_ids]
+        return self.frame_to_tracks.get(frame_id, set())
+
+    def get_track_lengths(self):
+        """
+        Get the length of every track, in the order of self.track_ids.
+        The array is computed once and reused until the tracks change.
+        :return: int32 array of track lengths.
+        """
+        if self._track_lengths is None:
+            self._track_lengths = np.fromiter((len(self.tracks[track_id].frame_ids) for track_id in self.track_ids),
+                                              dtype=np.int32, count=len(self.track_ids))
+        return self._track_lengths
 
     def get_frame_ids(self, track_id):
         """
@@ -67,10 +123,7 @@ class TracksDB:
         """
         Remove tracks that are too short (less than 2 frames).
         """
-        id_to_remove = []
-        for track_id in self.track_ids:
-            if len(self.tracks[track_id].frame_ids) < short:
-                id_to_remove.append(track_id)
+        id_to_remove = [track_id for track_id, length in zip(self.track_ids, self.get_track_lengths()) if length < short]
 
         for track_id in id_to_remove:
             self.remove_track(track_id)
@@ -80,8 +133,11 @@ class TracksDB:
         Remove a track from the database.
         :param track_id: TrackID to remove.
         """
-        self.tracks.pop(track_id)
+        track = self.tracks.pop(track_id)
         self.track_ids.remove(track_id)
+        self._track_lengths = None
+        for frame_id in track.frame_ids:
+            self.frame_to_tracks[frame_id].discard(track_id)
 
     # Implement an ability to extend the database with new tracks on a new
     # frame as we match new stereo pairs to the previous ones.
@@ -91,21 +147,23 @@ class TracksDB:
          with the previous frames in the tracks as a new frame in every track.
         """
         next_frame_idx = curr_frame_idx + 1
+        self._track_lengths = None
 
         # treats the kps as unique objects
         # get the tracks that include the previous frame_id
-        relevant_tracks = {track_id for track_id in self.track_ids if curr_frame_idx in self.tracks[track_id].frame_ids}
+        relevant_tracks = list(self.get_track_ids(curr_frame_idx))
+        tracks_kp = np.array([self.tracks[track_id].get_kp(curr_frame_idx) for track_id in relevant_tracks],
+                             dtype=np.float32).reshape(-1, 4)
+        left_kp, right_kp = curr_frame_supporters_kp
+        supporters_kp = np.hstack((left_kp, right_kp)).astype(np.float32, copy=False).reshape(-1, 4)
 
-        taken_kp_idxs = []
+        track_idxs, taken_kp_idxs = match_kps(tracks_kp, supporters_kp)
 
-        left_kp, right_kp = curr_frame_supporters_kp
-        for i in range(len(left_kp)):
-            for track_id in relevant_tracks:
-                track = self.tracks[track_id]
-                if left_kp[i] in track.kp[curr_frame_idx][0] and right_kp[i] in track.kp[curr_frame_idx][1]:
-                    track.add_frame(next_frame_idx, (next_frame_supporters_kp[0][i], next_frame_supporters_kp[1][i]))
-                    taken_kp_idxs.append(i)
-                    break  # advance to the next kp
+        next_left_kp, next_right_kp = next_frame_supporters_kp
+        for track_idx, kp_idx in zip(track_idxs, taken_kp_idxs):
+            track_id = relevant_tracks[track_idx]
+            self.tracks[track_id].add_frame(next_frame_idx, (next_left_kp[kp_idx], next_right_kp[kp_idx]))
+            self.frame_to_tracks[next_frame_idx].add(track_id)
 
         # Create new tracks for the kps that were not taken
         reminder_left_kp_curr, reminder_right_kp_curr = self.get_reminder_kp(taken_kp_idxs, curr_frame_supporters_kp)
@@ -137,8 +195,10 @@ class TracksDB:
         :param track: Track to add.
         """
         self.tracks[track.track_id] = track
-        self.frame_ids = self.frame_ids.union(track.frame_ids)
+        self.frame_ids.update(track.frame_ids)
         self.track_ids.append(track.track_id)
+        self.index_track(track)
+        self._track_lengths = None
 
     def get_new_id(self):
         """
@@ -154,11 +214,8 @@ class TracksDB:
         Returns feature locations of track TrackId on both left and right
          images as a triplet (xl, xr, y).
         """
-        if self.tracks[track_id] and frame_id in self.tracks[track_id].frame_ids:
-            xl = self.tracks[track_id].kp[frame_id][0][0]
-            xr = self.tracks[track_id].kp[frame_id][1][0]
-            y = self.tracks[track_id].kp[frame_id][0][1]
-            return xl, xr, y
+        if track_id in self.tracks:
+            return self.tracks[track_id].feature_location(frame_id)
         else:
             return None
 
@@ -169,7 +226,7 @@ class TracksDB:
         :param file_name: File name.
         """
         with open(file_name, 'wb') as file:
-            pickle.dump(self, file)
+            pickle.dump(self, file, protocol=pickle.HIGHEST_PROTOCOL)
 
     @staticmethod
     def deserialize(file_name):
@@ -195,7 +252,7 @@ class TracksDB:
         # get the number of frames
         num_frames = len(self.frame_ids)
         # get the track lengths
-        track_lengths = [len(self.tracks[track_id].frame_ids) for track_id in self.track_ids]
+        track_lengths = self.get_track_lengths()
         # get the mean track length
         mean_track_length = np.mean(track_lengths)
         # get the maximum track length
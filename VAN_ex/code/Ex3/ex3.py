@@ -5,7 +5,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 
-from VAN_ex.code.PreCalcData.paths_to_data import T_ARR_PATH
+from VAN_ex.code.PreCalcData.paths_to_data import T_ARR_PATH, REL_T_ARR_PATH
 from VAN_ex.code.utils import utils as utils
 import VAN_ex.code.Ex1.ex1 as ex1_utils
 import VAN_ex.code.Ex2.ex2 as ex2_utils
@@ -17,6 +17,7 @@ N_FEATURES = 1000
 PNP_POINTS = 4
 CONSENSUS_ACCURACY = 2
 MAX_RANSAC_ITERATIONS = 1000
+RANSAC_BATCH_SIZE = 16
 k, m1, m2 = ex2_utils.read_cameras()
 
 
@@ -110,31 +111,46 @@ def calculate_camera_trajectory(relative_T_arr):
     Calculate the camera trajectory according to the relative position of
      each camera.
     """
-    trajectory = []
-    for T in relative_T_arr:
-        trajectory.append(calc_relative_camera_pos(T))
-    return np.array(trajectory)
+    relative_T_arr = np.asarray(relative_T_arr)
+    return -np.einsum('nji,nj->ni', relative_T_arr[:, :, :3], relative_T_arr[:, :, 3])
 
 
 def composite_transformations(T1, T2):
     """
     Calculate the composite transformation between two cameras.
+    T1 and T2 may also be stacks of (N, 3, 4) matrices.
     """
-    R1, t1 = T1[:, :3], T1[:, 3]
-    R2, t2 = T2[:, :3], T2[:, 3]
-    hom1 = np.append(T1, [np.array([0, 0, 0, 1])], axis=0)
-    return T2 @ hom1
+    R1, t1 = T1[..., :3], T1[..., 3:]
+    R2, t2 = T2[..., :3], T2[..., 3:]
+    return np.concatenate((R2 @ R1, R2 @ t1 + t2), axis=-1)
 
 
 def calculate_relative_transformations(T_arr):
     """
     Calculate the relative transformations between each pair of cameras.
     """
-    relative_T_arr = [T_arr[0]]
+    relative_T_arr = np.array(T_arr, dtype=np.float64)  # (N, 3, 4), composed in place
+    R, t = relative_T_arr[:, :, :3], relative_T_arr[:, :, 3]
 
-    for i in range(1, len(T_arr)):
-        relative_T_arr.append(composite_transformations(relative_T_arr[-1], T_arr[i]))
-    return np.array(relative_T_arr)
+    # composite_transformations(relative_T_arr[i - 1], T_arr[i]) on the rotation and translation views
+    for i in range(1, len(relative_T_arr)):
+        t[i] += R[i] @ t[i - 1]
+        R[i] = R[i] @ R[i - 1]
+    return relative_T_arr
+
+
+def load_relative_transformations(t_arr_path=T_ARR_PATH, rel_t_arr_path=REL_T_ARR_PATH):
+    """
+    Load the relative transformations of the transformations saved in t_arr_path.
+    They are calculated once and saved to rel_t_arr_path, and calculated again only if t_arr_path
+     was modified after that.
+    """
+    if os.path.exists(rel_t_arr_path) and os.path.getmtime(rel_t_arr_path) >= os.path.getmtime(t_arr_path):
+        relative_T_arr = np.load(rel_t_arr_path)
+    else:
+        relative_T_arr = calculate_relative_transformations(np.load(t_arr_path))
+        np.save(rel_t_arr_path, relative_T_arr)
+    return relative_T_arr
 
 
 def project_and_measure(p3d_pts, camera_mat, inliers, accuracy=CONSENSUS_ACCURACY):
@@ -142,13 +158,14 @@ def project_and_measure(p3d_pts, camera_mat, inliers, accuracy=CONSENSUS_ACCURAC
     Projects the given p3d points using the camera matrix in order
     to recognize the supporters. Return whether each inlier is within the range
     of the distance threshold.
+    camera_mat may also be a stack of (H, 3, 4) matrices, then an (H, N) result is returned.
     """
-    R, t = camera_mat[:, :3], camera_mat[:, 3]
-    proj = p3d_pts @ R.T + t.T
-    proj = proj[:, :2] / proj[:, [2]]
+    R, t = camera_mat[..., :3], camera_mat[..., 3]
+    proj = p3d_pts @ np.swapaxes(R, -1, -2) + t[..., None, :]
+    proj = proj[..., :2] / proj[..., [2]]
     # sum_of_squared_diffs = np.sum(np.square(proj - inliers), axis=1)
     pts_sub = proj - inliers
-    sum_of_squared_diffs = np.einsum("ij,ij->i", pts_sub, pts_sub)  # (x1 - x2)^2 + (y1 - y2)^2
+    sum_of_squared_diffs = np.einsum("...ij,...ij->...i", pts_sub, pts_sub)  # (x1 - x2)^2 + (y1 - y2)^2
     return sum_of_squared_diffs <= accuracy ** 2
 
 
@@ -297,7 +314,12 @@ def calc_ext_mat_from_sample_idxs(sample_idxs, left1_inliers, pair0_p3d, flag=cv
 
 
 def calculate_camera_proj_matrices(left1_ext_mat):
-    right1_ext_mat = m2 @ np.vstack((left1_ext_mat, [np.array([0, 0, 0, 1])]))
+    """
+    Returns the left and right projection matrices of a left extrinsic matrix,
+     or of a stack of (H, 3, 4) extrinsic matrices.
+    """
+    right1_ext_mat = m2[:, :3] @ left1_ext_mat  # m2 composed after left1_ext_mat
+    right1_ext_mat[..., 3] += m2[:, 3]
     return k @ left1_ext_mat, k @ right1_ext_mat
 
 
@@ -320,31 +342,38 @@ def ransac_pnp(pair0_p3d, left1_inliers, right1_inliers):
     Calculates PnP using Ransac.
     """
     best_num_supporters, best_ext_mat, best_supporters = 0, None, None
-    N1, p, eps, sum_outliers, sum_inliers = 0, 0.999, 0.99, 0, 0  # To bound number of iterations
-    max_iterations = estimate_iterations(p, eps)
-
-    while eps != 0 and (N1 < estimate_iterations(p, eps)) and N1 < MAX_RANSAC_ITERATIONS:
-        random_idx = np.random.choice(len(pair0_p3d), size=PNP_POINTS, replace=False)  # Random sample 4 points
-        left1_ext_mat = calc_ext_mat_from_sample_idxs(random_idx, left1_inliers, pair0_p3d, flag=cv2.SOLVEPNP_P3P)
-        # if AP3P fails, try again
-        if left1_ext_mat is None:
+    p, eps = 0.999, 0.99  # eps is the outliers fraction of the best model found so far
+    N1, max_iterations = 0, min(estimate_iterations(p, eps), MAX_RANSAC_ITERATIONS)  # To bound number of iterations
+
+    while N1 < max_iterations:
+        # Solve a batch of hypotheses, then score all of them against all the points at once
+        batch_size = min(RANSAC_BATCH_SIZE, max_iterations - N1)
+        N1 += batch_size
+        ext_mats = []
+        for _ in range(batch_size):
+            random_idx = np.random.choice(len(pair0_p3d), size=PNP_POINTS, replace=False)  # Random sample 4 points
+            left1_ext_mat = calc_ext_mat_from_sample_idxs(random_idx, left1_inliers, pair0_p3d, flag=cv2.SOLVEPNP_P3P)
+            # if AP3P fails, try again
+            if left1_ext_mat is not None:
+                ext_mats.append(left1_ext_mat)
+        if not ext_mats:
             continue
 
-        left_T, right_T = calculate_camera_proj_matrices(left1_ext_mat)
-        supporters_idx = find_consensus_supporters(pair0_p3d, left_T, left1_inliers, right_T, right1_inliers)
+        ext_mats = np.array(ext_mats)
+        left_Ts, right_Ts = calculate_camera_proj_matrices(ext_mats)
+        supporters = project_and_measure(pair0_p3d, left_Ts, left1_inliers) & \
+                     project_and_measure(pair0_p3d, right_Ts, right1_inliers)  # (H, N)
+        num_supporters = supporters.sum(axis=1)
+        best_idx = np.argmax(num_supporters)
 
-        if len(supporters_idx) > best_num_supporters:
-            best_num_supporters = len(supporters_idx)
-            best_supporters = supporters_idx
-            best_ext_mat = left1_ext_mat
+        if num_supporters[best_idx] > best_num_supporters:
+            best_num_supporters = num_supporters[best_idx]
+            best_supporters = np.where(supporters[best_idx])[0]
+            best_ext_mat = ext_mats[best_idx]
 
-        # Update Ransac parameters
-        N1 += 1
-        sum_outliers += (len(left1_inliers) - len(supporters_idx))
-        sum_inliers += len(supporters_idx)
-        eps = min(sum_outliers / (sum_inliers + sum_outliers), 0.99)
-        if eps == 0:
-            print("eps is zero")
+            # Update Ransac parameters, the bound only shrinks as the best model improves
+            eps = min(1 - best_num_supporters / len(left1_inliers), 0.99)
+            max_iterations = min(estimate_iterations(p, eps), MAX_RANSAC_ITERATIONS)
 
     # Refinement
     # best_ext_mat, best_supporters = refine_ransac(best_supporters, left1_inliers, right1_inliers, pair0_p3d, iters=1)
@@ -441,16 +470,11 @@ def one_run_over_ex3(idxs):
 def get_ground_truth_transformations(left_cam_trans_path=CAM_TRAJ_PATH, movie_len=MOVIE_LENGTH):
     """
     Reads the ground truth transformations
-    :return: array of transformation
-    """
-    T_ground_truth_arr = []
-    with open(left_cam_trans_path) as f:
-        lines = f.readlines()
-        print("Number of lines: ", len(lines))
-    for i in range(movie_len + 1):
-        left_mat = np.array(lines[i].split(" "))[:-1].astype(float).reshape((3, 4))
-        T_ground_truth_arr.append(left_mat)
-    return T_ground_truth_arr
+    :return: (movie_len + 1, 3, 4) array of transformations
+    """
+    # parse the whole file in a single call, one 3x4 matrix per line
+    T_ground_truth_arr = np.loadtxt(left_cam_trans_path, dtype=np.float64, max_rows=movie_len + 1)
+    return T_ground_truth_arr.reshape(-1, 3, 4)
 
 
 @utils.measure_time
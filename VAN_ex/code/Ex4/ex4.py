@@ -1,4 +1,7 @@
 import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 from matplotlib import animation
 
@@ -19,8 +22,10 @@ MAX_RANSAC_ITERATIONS = 1000
 START_FRAME = 0
 END_FRAME = 50
 TRACK_MIN_LEN = 10
+PAIRS_PER_TASK = 8  # Frame pairs sent to a worker process at once, to amortize the IPC
 DB_PATH = "tracks_db.pkl"
 k, m1, m2 = ex2_utils.read_cameras()
+k_m2 = k @ m2  # Right camera projection matrix, relative to the left camera
 # End Constants #
 
 
@@ -46,16 +51,23 @@ def create_gif(start_frame, end_frame, tracks_db):
     # reverse order of tracks_db.track_ids
     # reversed_idx = tracks_db.track_ids[::-1]
     # only tracks that have at least 10 frames
-    tracks_to_show = [track_id for track_id in tracks_db.track_ids if
-                      len(tracks_db.tracks[track_id].frame_ids) > TRACK_MIN_LEN]
+    tracks_to_show = [track_id for track_id, length in zip(tracks_db.track_ids, tracks_db.get_track_lengths()) if
+                      length > TRACK_MIN_LEN]
+    # gather the points of all the tracks per frame, so every frame gets a single scatter artist
+    xs_per_frame, ys_per_frame, colors_per_frame = defaultdict(list), defaultdict(list), defaultdict(list)
     for i, track_id in enumerate(tracks_to_show):
         track = tracks_db.tracks[track_id]
         color = cmap(i % 20)
-        for frame_id in track.frame_ids:
-            # if frame_id is in ims range
-            if frame_id - start_frame < len(ims):
-                ims[frame_id].append(
-                    axes.scatter(track.kp[frame_id][0][0], track.kp[frame_id][0][1], color=color, animated=True))
+        for frame_id, (x, y) in zip(track.frame_ids, track.left_locations()):
+            xs_per_frame[frame_id].append(x)
+            ys_per_frame[frame_id].append(y)
+            colors_per_frame[frame_id].append(color)
+
+    for frame_id in xs_per_frame:
+        # if frame_id is in ims range
+        if 0 <= frame_id - start_frame < len(ims):
+            ims[frame_id - start_frame].append(axes.scatter(xs_per_frame[frame_id], ys_per_frame[frame_id],
+                                                            color=colors_per_frame[frame_id], animated=True))
 
     ani = animation.ArtistAnimation(fig, ims, interval=100, repeat_delay=3000, blit=True)
     # save but compress it first so it won't be too big
@@ -88,10 +100,7 @@ def plot_random_track(track):
     ims = []
     for frame_id in track.frame_ids:
         left0_image, right0_image = ex1_utils.read_images(frame_id)
-        left_x_cor = track.kp[frame_id][0][0]
-        left_y_cor = track.kp[frame_id][0][1]
-        right_x_cor = track.kp[frame_id][1][0]
-        right_y_cor = track.kp[frame_id][1][1]
+        left_x_cor, left_y_cor, right_x_cor, right_y_cor = track.get_kp(frame_id)
         left_x_cor_rounded = int(np.floor(left_x_cor))
         left_y_cor_rounded = int(np.floor(left_y_cor))
         right_x_cor_rounded = int(np.floor(right_x_cor))
@@ -121,13 +130,13 @@ def plot_connectivity_graph(tracks_db):
      links also in the next frame)
     """
     outgoing_tracks = []
-    frames = list(tracks_db.frame_ids)[:-1]  # Exclude the last frame
+    frames = sorted(tracks_db.frame_ids)[:-1]  # Exclude the last frame
 
     for frame in frames:
         curr_tracks = tracks_db.get_track_ids(frame)
         next_tracks = tracks_db.get_track_ids(frame + 1)
         # Count the shared tracks between the two frames
-        num_tracks = len(set(curr_tracks).intersection(next_tracks))
+        num_tracks = len(curr_tracks & next_tracks)
         outgoing_tracks.append(num_tracks)
 
     fig = plt.figure(figsize=(13, 5))
@@ -145,9 +154,8 @@ def plot_track_length_histogram(tracks_db):
     """
     Present a track length histogram graph, according to the tracks in the db.
     """
-    track_lengths = [len(tracks_db.tracks[track_id].frame_ids) for track_id in tracks_db.track_ids]
-    x_axis = [i for i in range(max(track_lengths))]
-    num_tracks = [track_lengths.count(i) for i in x_axis]
+    num_tracks = np.bincount(tracks_db.get_track_lengths())  # number of tracks of every length, up to the longest one
+    x_axis = np.arange(num_tracks.size)
 
     fig = plt.figure(figsize=(13, 5))
     plt.title('Track length histogram')
@@ -172,16 +180,17 @@ def read_gt_cam_mat():
     """
     Read the ground truth camera matrices (in \poses\05.txt).
     """
-    gt_cam_matrices = list()
-
-    with open(CAM_TRAJ_PATH) as f:
-        lines = f.readlines()
+    gt_cam_matrices = np.loadtxt(CAM_TRAJ_PATH, dtype=np.float64)
+    return list(gt_cam_matrices.reshape(-1, 3, 4))
 
-    for line in lines:
-        line = line.strip().split(' ')
-        gt_cam_matrices.append(np.array(line).reshape(3, 4).astype(np.float64))
 
-    return gt_cam_matrices
+def project_on_cameras(p3d, proj_mats):
+    """
+    Projects a single 3D point using a stack of (..., 3, 4) projection matrices.
+    :return: (..., 2) array of the pixel locations.
+    """
+    proj = proj_mats @ np.append(p3d, 1)
+    return proj[..., :2] / proj[..., 2:]
 
 
 # q4.7
@@ -192,43 +201,28 @@ def plot_reprojection_error(tracks_db):
     # Read the ground truth camera matrices (in \poses\05.txt)
     gt_cam_matrices = ex3_utils.get_ground_truth_transformations()
 
-    # Triangulate a 3d point in world coordinates from the features in the last frame of the track
     track = get_rand_track(TRACK_MIN_LEN, tracks_db)
 
-    left_locations = track.get_left_kp()
-    right_locations = track.get_right_kp()
+    # (F, 2, 2) locations of the track - left and right camera of every frame
+    locations = track.locations().reshape(-1, 2, 2)
 
-    last_gt_mat = gt_cam_matrices[max(track.frame_ids)]
-    last_left_proj_mat = k @ last_gt_mat
-    last_right_proj_mat = k @ ex3_utils.composite_transformations(last_gt_mat, m2)
+    # Projection matrices of all the frames of the track (both left and right cameras)
+    gt_mats = np.stack(gt_cam_matrices[min(track.frame_ids):max(track.frame_ids) + 1])  # (F, 3, 4)
+    right_proj_mats = k_m2[:, :3] @ gt_mats  # k @ composite_transformations(gt_mat, m2) for all the frames
+    right_proj_mats[:, :, 3] += k_m2[:, 3]
+    proj_mats = np.stack((k @ gt_mats, right_proj_mats), axis=1)  # (F, 2, 3, 4)
 
-    last_left_img_coords = left_locations[track.frame_ids[-1]]
-    last_right_img_coords = right_locations[track.frame_ids[-1]]
-    p3d = utils.triangulate_points(last_left_proj_mat, last_right_proj_mat, [last_left_img_coords],
-                                   [last_right_img_coords])
+    # Triangulate a 3d point in world coordinates from the features in the last frame of the track
+    p3d = utils.triangulate_points(proj_mats[-1, 0], proj_mats[-1, 1], [locations[-1, 0]], [locations[-1, 1]])
 
     # Project this point to all the frames of the track (both left and right cameras)
-    left_projections, right_projections = [], []
-
-    for gt_cam_mat in gt_cam_matrices[min(track.frame_ids):max(track.frame_ids) + 1]:
-        left_proj_cam = k @ gt_cam_mat
-        left_projections.append(utils.project(p3d, left_proj_cam)[0])
-
-        right_proj_cam = k @ ex3_utils.composite_transformations(gt_cam_mat, m2)
-        right_projections.append(utils.project(p3d, right_proj_cam)[0])
-
-    left_projections, right_projections = np.array(left_projections), np.array(right_projections)
+    projections = project_on_cameras(p3d[0], proj_mats)
 
     # We’ll define the reprojection error for a given camera as the distance between the projection
     # and the tracked feature location on that camera.
 
-    # Calculate the reprojection error for each frame of the track
-    left_locations = np.array(list(left_locations.values()))
-    right_locations = np.array(list(right_locations.values()))
-
-    left_proj_dist = np.linalg.norm(left_projections - left_locations, axis=1)
-    right_proj_dist = np.linalg.norm(right_projections - right_locations, axis=1)
-    total_proj_dist = (left_proj_dist + right_proj_dist) / 2
+    # Calculate the reprojection error for each frame of the track, as the mean over its two cameras
+    total_proj_dist = np.linalg.norm(projections - locations, axis=2).mean(axis=1)
 
     # Present a graph of the reprojection error over the track’s images.
     fig = plt.figure(figsize=(13, 5))
@@ -270,19 +264,36 @@ def plot_matches_per_frame(tracks_db):
     plt.close(fig)
 
 
+def track_pair(idx):
+    """
+    Track the movement between frame idx and frame idx + 1.
+    Defined at module level so worker processes can run it. RANSAC is seeded by the frame index,
+     so the result doesn't depend on which worker tracks the pair.
+    """
+    np.random.seed(idx)
+    return ex3_utils.track_movement_successive([idx, idx + 1])
+
+
 @utils.measure_time
-def run_sequence(start_frame, end_frame):
+def run_sequence(start_frame, end_frame, workers=None):
+    """
+    Build the tracks database of the given frames. The pairs of successive frames are independent,
+     so they are tracked in parallel (workers=None uses all the cores), and the results are added
+     to the database in frame order.
+    """
     db = TracksDB()
     inliers_precent_lst = []
-    for idx in range(start_frame, end_frame):
-        left_ext_mat, inliers, inliers_precent = ex3_utils.track_movement_successive([idx, idx + 1])
-        inliers_precent_lst.append(inliers_precent)
-        if left_ext_mat is not None:
-            left0_kp, right0_kp, left1_kp, right1_kp = inliers
-            db.extend_tracks(idx, (left0_kp, right0_kp), (left1_kp, right1_kp))
-        else:
-            print("something went wrong, no left_ext_mat")
-        print(" -- Step {} -- ".format(idx))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # map yields the results in the order of the frames, as extend_tracks requires
+        results = executor.map(track_pair, range(start_frame, end_frame), chunksize=PAIRS_PER_TASK)
+        for idx, (left_ext_mat, inliers, inliers_precent) in zip(range(start_frame, end_frame), results):
+            inliers_precent_lst.append(inliers_precent)
+            if left_ext_mat is not None:
+                left0_kp, right0_kp, left1_kp, right1_kp = inliers
+                db.extend_tracks(idx, (left0_kp, right0_kp), (left1_kp, right1_kp))
+            else:
+                print("something went wrong, no left_ext_mat")
+            print(" -- Step {} -- ".format(idx))
     frames = [i for i in range(start_frame, end_frame)]
     plot_inliers_per_frame(inliers_precent_lst, frames)  # q4.5
     # db.remove_short_tracks(short=2)
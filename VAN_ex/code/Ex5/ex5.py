@@ -5,10 +5,11 @@ import matplotlib.pyplot as plt
 
 import VAN_ex.code.Ex1.ex1 as ex1_utils
 import VAN_ex.code.Ex3.ex3 as ex3_utils
-from VAN_ex.code.PreCalcData.paths_to_data import DB_PATH, T_ARR_PATH, BA_PATH
+from VAN_ex.code.PreCalcData.paths_to_data import DB_PATH, BA_PATH
 from VAN_ex.code.utils import utils, projection_utils, auxilery_plot_utils
 from VAN_ex.code.DataBase.TracksDB import TracksDB
 from VAN_ex.code.BundleAdjustment import BundleWindow
+from VAN_ex.code.BundleAdjustment.BundleWindow import K, STEREO_NOISE
 from VAN_ex.code.BundleAdjustment import BundleAdjustment
 from VAN_ex.code.utils.auxilery_plot_utils import plot_scene_from_above, plot_scene_3d
 
@@ -17,10 +18,10 @@ from VAN_ex.code.utils.auxilery_plot_utils import plot_scene_from_above, plot_sc
 old_k, m1, m2 = ex3_utils.k, ex3_utils.m1, ex3_utils.m2
 
 
-def q5_1(track_db: TracksDB):
+def q5_1(track_db: TracksDB, T_arr):
     track = utils.get_rand_track(10, track_db, seed=5)
-    left_proj, right_proj, initial_estimates, factors = triangulate_and_project(track, track_db)
-    left_locations, right_locations = track.get_left_kp(), track.get_right_kp()
+    left_proj, right_proj, initial_estimates, factors = triangulate_and_project(track, track_db, T_arr)
+    left_locations, right_locations = track.left_locations(), track.right_locations()
 
     # Present a graph of the reprojection error size (L2 norm) over the track’s images
     total_proj_dist, right_proj_dist, left_proj_dist = calculate_reprojection_error((left_proj, right_proj),
@@ -30,6 +31,7 @@ def q5_1(track_db: TracksDB):
 
     # Present a graph of the factor error over the track’s images.
     errors = plot_factor_error(factors, initial_estimates, track.get_frame_ids(), fig)
+    plt.close(fig)
 
     # Present a graph of the factor error as a function of the re-projection error.
     plot_factor_vs_reprojection_error(errors, total_proj_dist)
@@ -72,7 +74,7 @@ def q5_2(tracks_db, t_arr):
     # position of q.
     c, q = random_factor.keys()
     pose = bundle_window.initial_estimates.atPose3(c)
-    stereo_camera = gtsam.StereoCamera(pose, utils.create_gtsam_K())
+    stereo_camera = gtsam.StereoCamera(pose, K)
     p3d = bundle_window.initial_estimates.atPoint3(q)
     first_proj = stereo_camera.project(p3d)
     first_lproj, first_rproj = (first_proj.uL(), first_proj.v()), (first_proj.uR(), first_proj.v())
@@ -85,7 +87,7 @@ def q5_2(tracks_db, t_arr):
     # Repeat this process for the final (optimized) values of c and q.
     print('Final error of random factor = {}'.format(random_factor.error(result)))
     pose = bundle_window.result.atPose3(c)
-    stereo_camera = gtsam.StereoCamera(pose, utils.create_gtsam_K())
+    stereo_camera = gtsam.StereoCamera(pose, K)
     p3d = bundle_window.result.atPoint3(q)
     projection = stereo_camera.project(p3d)
     left_proj, right_proj = (projection.uL(), projection.v()), (projection.uR(), projection.v())
@@ -112,12 +114,13 @@ def q5_3(tracks_db, T_arr):
     # convert relative poses to absolute poses
     cameras, landmarks = bundle_adjustment.get_relative_poses()
 
-    ground_truth_keyframes = \
-        np.array(ex3_utils.calculate_camera_trajectory(ex3_utils.get_ground_truth_transformations()))[
-            bundle_adjustment.keyframes]
+    # The optimization is done in float64, the arrays below are only plotted and compared, so float32 is enough
+    landmarks = landmarks.astype(np.float32)
+    ground_truth_keyframes = ex3_utils.calculate_camera_trajectory(ex3_utils.get_ground_truth_transformations())[
+        bundle_adjustment.keyframes].astype(np.float32)
 
-    cameras_trajectory = projection_utils.get_trajectory_from_gtsam_poses(cameras)
-    initial_est = utils.get_initial_estimation(rel_t_arr=T_arr)[bundle_adjustment.keyframes]
+    cameras_trajectory = projection_utils.get_trajectory_from_gtsam_poses(cameras).astype(np.float32)
+    initial_est = utils.get_initial_estimation(rel_t_arr=T_arr)[bundle_adjustment.keyframes].astype(np.float32)
 
     fig, axes = plt.subplots(figsize=(6, 6))
     fig = auxilery_plot_utils.plot_camera_trajectory(camera_pos=landmarks, fig=fig, label="projected landmarks",
@@ -129,8 +132,7 @@ def q5_3(tracks_db, T_arr):
     legend_element = plt.legend(loc='upper left', fontsize=12)
     fig.gca().add_artist(legend_element)
     fig.savefig('q5_3 trajectory.png')
-    fig.show()
-    plt.clf()
+    plt.close(fig)
 
     # For the last bundle window print the final position of the first frame of that bundle and the anchoring factor
     # final error. Why is that the error?
@@ -138,14 +140,14 @@ def q5_3(tracks_db, T_arr):
     print('Final error = {}'.format(last_bundle.prior_factor.error(last_bundle.result)))
     print('Final position of the first frame = {}'.format(last_bundle.get_from_optimized(obj='camera_poses')[0]))
 
-    euclidean_distance = calculate_euclidian_dist(cameras_trajectory, ground_truth_keyframes)
+    euclidean_distance = utils.calculate_euclidian_dist(cameras_trajectory, ground_truth_keyframes)
     plot_keyframe_localization_error(len(bundle_adjustment.keyframes), euclidean_distance)
 
 
 # ===== Helper functions =====
 
 
-def triangulate_and_project(track, tracks_db, T_arr=None):
+def triangulate_and_project(track, tracks_db, T_arr):
     """
     For all the frames participating in this track, define a gtsam.StereoCamera
      using the global camera matrices calculated in exercise 3 (PnP).
@@ -154,76 +156,81 @@ def triangulate_and_project(track, tracks_db, T_arr=None):
      of the track (both left and right cameras).
     Moreover, Create a factor for each frame projection and present a graph of the
      factor error over the track’s frames.
+    :param T_arr: Relative transformations of all the frames, as calculated once by the caller.
     """
-    # Load and set initial values
-    if T_arr is None:
-        T_arr = np.load(T_ARR_PATH)
-        T_arr = ex3_utils.calculate_relative_transformations(T_arr)
     initial_estimates = gtsam.Values()
-    K = utils.create_gtsam_K()
 
     track_frames = track.get_frame_ids()
-    last_frame_id = track_frames[-1]
-    last_frame_ext_mat = T_arr[last_frame_id]
     first_frame_id = track_frames[0]
     first_frame_ext_mat = T_arr[first_frame_id]
 
-    # world_base_camera = fix_ext_mat(first_frame_ext_mat)  # World coordinates for transformations
-    last_frame_in_world = ex3_utils.composite_transformations(first_frame_ext_mat, last_frame_ext_mat)
+    # gtsam poses of all the frames of the track, composed with the first frame in one batched call
+    track_ext_mats = ex3_utils.composite_transformations(first_frame_ext_mat, T_arr[track_frames])  # (N, 3, 4)
+    track_poses = fix_ext_mat(track_ext_mats)
 
     point_symbol = gtsam.symbol('q', 0)
-    base_pose = gtsam.Pose3(fix_ext_mat(last_frame_in_world))
+    base_pose = gtsam.Pose3(track_poses[-1])
     base_stereo_frame = gtsam.StereoCamera(base_pose, K)
-    xl, xr, y = track.feature_location(last_frame_id)
-    point = gtsam.StereoPoint2(xl, xr, y)
+    feature_locations = track.feature_locations().tolist()  # (xl, xr, y) of every frame of the track
+    point = gtsam.StereoPoint2(*feature_locations[-1])
     p3d = base_stereo_frame.backproject(point)
     initial_estimates.insert(point_symbol, p3d)
 
-    # Create a factor for each frame projection and present a graph of the factor error over the track’s frames.
-    factors, left_proj, right_proj = [], [], []
-
-    for frame_id in track_frames:
-        ext_mat = T_arr[frame_id]
-        cur_ext_mat = ex3_utils.composite_transformations(first_frame_ext_mat, ext_mat)
+    # Project the point to all the frames of the track at once
+    left_proj, right_proj = stereo_project(p3d, track_ext_mats)
 
-        cam_symbol = gtsam.symbol('c', frame_id)
-        pose = gtsam.Pose3(fix_ext_mat(cur_ext_mat))
-        initial_estimates.insert(cam_symbol, pose)
-        stereo_frame = gtsam.StereoCamera(pose, K)
-        projection = stereo_frame.project(p3d)  # Project point for each frame in track
-        left_proj.append((projection.uL(), projection.v()))
-        right_proj.append((projection.uR(), projection.v()))
+    # Create a factor for each frame projection and present a graph of the factor error over the track’s frames.
+    factors = []
+    cam_symbols = [gtsam.symbol('c', frame_id) for frame_id in track_frames]
+    for cam_symbol, pose_mat, feature_location in zip(cam_symbols, track_poses, feature_locations):
+        initial_estimates.insert(cam_symbol, gtsam.Pose3(pose_mat))
 
-        xl, xr, y = track.feature_location(frame_id)
-        point = gtsam.StereoPoint2(xl, xr, y)
+        point = gtsam.StereoPoint2(*feature_location)
 
         # Create a factor for each frame projection and present a graph of the factor error over the track’s frames.
-        factor = gtsam.GenericStereoFactor3D(point, gtsam.noiseModel.Isotropic.Sigma(3, 1.0), cam_symbol, point_symbol,
-                                             K)
+        factor = gtsam.GenericStereoFactor3D(point, STEREO_NOISE, cam_symbol, point_symbol, K)
         factors.append(factor)
 
     return left_proj, right_proj, initial_estimates, factors
 
 
+def stereo_project(p3d, ext_mats):
+    """
+    Project a 3d point to a stack of (N, 3, 4) extrinsic matrices with the stereo calibration K,
+     the same as gtsam.StereoCamera(pose, K).project(p3d) does for each of them.
+    :return: (N, 2) arrays of the left and right projections.
+    """
+    x, y, z = (ext_mats[:, :, :3] @ np.asarray(p3d) + ext_mats[:, :, 3]).T  # Point in each camera's coordinates
+    u_left = K.px() + (K.fx() * x + K.skew() * y) / z
+    u_right = u_left - K.fx() * K.baseline() / z
+    v = K.py() + K.fy() * y / z
+    left_proj = np.column_stack((u_left, v)).astype(np.float32)
+    right_proj = np.column_stack((u_right, v)).astype(np.float32)
+    return left_proj, right_proj
+
+
 def fix_ext_mat(ext_mat):
     """
     Fix the extrinsic matrix to be in the correct format for gtsam.
+    ext_mat may also be a stack of (N, 3, 4) matrices, then all of them are fixed at once.
     """
-    R = ext_mat[:, :3]
-    t = ext_mat[:, 3]
-    new_t = -R.T @ t
-    return np.hstack((R.T, new_t.reshape(3, 1)))
+    R_T = np.swapaxes(ext_mat[..., :3], -1, -2)
+    new_t = -R_T @ ext_mat[..., 3:]
+    return np.concatenate((R_T, new_t), axis=-1)
 
 
 def calculate_reprojection_error(projections, locations):
     """
     Calculate the reprojection error size (L2 norm) over the track’s images.
+    :param projections: (N, 2) arrays of the left and right projections.
+    :param locations: (N, 2) arrays of the left and right feature locations, as in Track.left_locations().
     """
     left_projections, right_projections = projections
     left_locations, right_locations = locations
-    left_locations, right_locations = np.array(list(left_locations.values())), np.array(list(right_locations.values()))
-    left_proj_dist = np.linalg.norm(left_projections - left_locations, axis=1, ord=2)
-    right_proj_dist = np.linalg.norm(right_projections - right_locations, axis=1, ord=2)
+    left_proj_dist = np.hypot(left_projections[:, 0] - left_locations[:, 0],
+                              left_projections[:, 1] - left_locations[:, 1])
+    right_proj_dist = np.hypot(right_projections[:, 0] - right_locations[:, 0],
+                               right_projections[:, 1] - right_locations[:, 1])
     total_proj_dist = (left_proj_dist + right_proj_dist) / 2
     return total_proj_dist, left_proj_dist, right_proj_dist
 
@@ -274,6 +281,7 @@ def plot_factor_vs_reprojection_error(errors, total_proj_dist):
     ax.set_ylabel('Factor error')
     ax.set_xlabel('Reprojection error')
     plt.savefig('factor_vs_reprojection_error.png')
+    plt.close(fig)
 
 
 def plot_keyframe_localization_error(keyframes_len, errors):
@@ -286,12 +294,7 @@ def plot_keyframe_localization_error(keyframes_len, errors):
     ax.set_ylabel('Error')
     ax.set_xlabel('Time')
     plt.savefig('keyframe_localization_error.png')
-
-
-def calculate_euclidian_dist(abs_cameras, ground_truth_cameras):
-    pts_sub = abs_cameras - ground_truth_cameras
-    sum_of_squared_diffs = np.linalg.norm(pts_sub, axis=1)
-    return np.sqrt(sum_of_squared_diffs)
+    plt.close(fig)
 
 
 def plot_proj_on_images(left_proj, right_proj, left_point, right_point, left_image, right_image, type):
@@ -315,6 +318,7 @@ def plot_proj_on_images(left_proj, right_proj, left_point, right_point, left_ima
 
     plt.legend(fontsize="7")
     plt.savefig('proj_on_images_{}.png'.format(type))
+    plt.close(fig)
 
 
 # ===== End of Helper Functions =====
@@ -324,13 +328,15 @@ def run_ex5():
     """
     Runs all exercise 5 sections.
     """
+    # All the plots are only saved to files, so render them without a GUI backend
+    plt.switch_backend('Agg')
+    plt.rcParams['agg.path.chunksize'] = 10000
     np.random.seed(5)
     # Load tracks DB
     tracks_db = TracksDB.deserialize(DB_PATH)
-    T_arr = np.load(T_ARR_PATH)
-    rel_t_arr = ex3_utils.calculate_relative_transformations(T_arr)
+    rel_t_arr = ex3_utils.load_relative_transformations()
 
-    # q5_1(tracks_db)
+    # q5_1(tracks_db, rel_t_arr)
     # q5_2(tracks_db, rel_t_arr)
     q5_3(tracks_db, rel_t_arr)
 
@@ -7,14 +7,14 @@ from gtsam.utils import plot
 import matplotlib.pyplot as plt
 
 from VAN_ex.code.BundleAdjustment.BundleAdjustment import BundleAdjustment
-from VAN_ex.code.Ex3.ex3 import calculate_relative_transformations
+from VAN_ex.code.Ex3.ex3 import load_relative_transformations
 from VAN_ex.code.DataBase.TracksDB import TracksDB
 from VAN_ex.code.DataBase.Track import Track
-from VAN_ex.code.PreCalcData.paths_to_data import BA_PATH, DB_PATH, T_ARR_PATH
+from VAN_ex.code.PreCalcData.paths_to_data import BA_PATH, DB_PATH
 from VAN_ex.code.utils.auxilery_plot_utils import plot_scene_from_above, plot_scene_3d
 from VAN_ex.code.BundleAdjustment import BundleWindow
 from VAN_ex.code.PoseGraph.PoseGraph import PoseGraph
-from VAN_ex.code.utils import projection_utils, auxilery_plot_utils
+from VAN_ex.code.utils import utils, projection_utils, auxilery_plot_utils
 
 def q6_1(T_arr, tracks_db):
     """
@@ -39,9 +39,7 @@ def q6_1(T_arr, tracks_db):
     keys = gtsam.KeyVector()
     keys.append(gtsam.symbol('c', c0))
     keys.append(gtsam.symbol('c', ck))
-    # rel_cov = marginals.jointMarginalCovariance(keys).at(keys[1], keys[1])  # Cov of the relative motion
-    marg_cov_mat = marginals.jointMarginalInformation(keys).at(keys[1], keys[1])  # Conditioning on the second keyframe
-    rel_cov = np.linalg.inv(marg_cov_mat)  # Cov of the relative motion, as seen in lecture
+    rel_cov = utils.relative_covariance(marginals, keys)  # Cov of the relative motion, as seen in lecture
 
     # Calculate the relative pose between the first two keyframes
     pose_c0 = result.atPose3(gtsam.symbol('c', c0))
@@ -86,8 +84,7 @@ def run_ex6():
     np.random.seed(1)
     # Load tracks DB
     tracks_db = TracksDB.deserialize(DB_PATH)
-    T_arr = np.load(T_ARR_PATH)
-    rel_t_arr = calculate_relative_transformations(T_arr)
+    rel_t_arr = load_relative_transformations()
     ba = None
     # ba = BundleAdjustment.deserialize(BA_PATH)
 
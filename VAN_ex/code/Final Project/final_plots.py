@@ -549,7 +549,7 @@ def projection_error_track_length_pnp(tracks_subset):
     for i, track in enumerate(tracks_subset):
         left_proj, right_proj, initial_estimates, factors = ex5_utils.triangulate_and_project(track, None,
                                                                                               T_arr=rel_t_arr)
-        left_locations, right_locations = track.get_left_kp(), track.get_right_kp()
+        left_locations, right_locations = track.left_locations(), track.right_locations()
         _, right_proj_dist, left_proj_dist = ex5_utils.calculate_reprojection_error((left_proj, right_proj),
                                                                                     (left_locations, right_locations))
         projection_errors[i] = left_proj_dist
@@ -609,7 +609,7 @@ def projection_error_track_length_ba(tracks_db, tracks_subset, ba):
     for i, track in enumerate(tracks_subset):
         left_proj, right_proj, initial_estimates, factors = ex5_utils.triangulate_and_project(track, None,
                                                                                               T_arr=rel_t_arr)
-        left_locations, right_locations = track.get_left_kp(), track.get_right_kp()
+        left_locations, right_locations = track.left_locations(), track.right_locations()
         _, right_proj_dist, left_proj_dist = ex5_utils.calculate_reprojection_error((left_proj, right_proj),
                                                                                     (left_locations, right_locations))
         projection_errors[i] = left_proj_dist
@@ -211,9 +211,7 @@ class PoseGraph:
             traceback.print_exc()
             # exit(1)
             return
-        # rel_cov = marginals.jointMarginalCovariance(keys).at(keys[1], keys[1])
-        joint_information_mat = marginals.jointMarginalInformation(keys).at(keys[1], keys[1])
-        rel_cov = np.linalg.inv(joint_information_mat)
+        rel_cov = utils.relative_covariance(marginals, keys)
 
         first_pose = bundle.result.atPose3(gtsam.symbol('c', first_kf))
         second_pose = bundle.result.atPose3(gtsam.symbol('c', second_kf))
@@ -3,6 +3,7 @@ import os
 RELATIVES_PATH = os.path.join('..', 'ex6', 'relatives.pkl')
 DB_PATH = os.path.join('..', 'Ex4', 'tracks_db.pkl')
 T_ARR_PATH = os.path.join('..', 'Ex3', 'T_arr.npy')
+REL_T_ARR_PATH = os.path.join('..', 'Ex3', 'rel_T_arr.npy')
 BA_PATH = os.path.join('..', 'Ex5', 'ba.pkl')
 PG_PATH = os.path.join('..', 'Ex6', 'pg.pkl')
 
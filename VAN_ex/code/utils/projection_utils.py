@@ -5,21 +5,24 @@ import numpy as np
 
 
 def convert_ext_mat_to_world(ext_mat):
-    R_mat = ext_mat[:, :3]
-    t_vec = ext_mat[:, 3]
-
-    R = R_mat.T
-    t = - R_mat.T @ t_vec
+    """
+    Convert an extrinsic matrix [R|t] to the camera pose in world coordinates [R.T|-R.T @ t].
+    ext_mat may also be a stack of (N, 3, 4) matrices, then all of them are converted at once.
+    """
+    R = np.swapaxes(ext_mat[..., :3], -1, -2)
+    t = -R @ ext_mat[..., 3:]
 
-    return np.hstack((R, t.reshape(3, 1)))
+    return np.concatenate((R, t), axis=-1)
 
 
 def composite_transformations(T1, T2):
     """
     Calculate the composite transformation between two cameras.
+    T1 and T2 may also be stacks of (N, 3, 4) matrices.
     """
-    hom1 = np.append(T1, [np.array([0, 0, 0, 1])], axis=0)
-    return T2 @ hom1
+    R1, t1 = T1[..., :3], T1[..., 3:]
+    R2, t2 = T2[..., :3], T2[..., 3:]
+    return np.concatenate((R2 @ R1, R2 @ t1 + t2), axis=-1)
 
 
 def convert_rel_gtsam_trans_to_global(T_arr):
@@ -36,14 +39,11 @@ def convert_rel_gtsam_trans_to_global(T_arr):
 def convert_from_bundel_to_world(first_cam: gtsam.Pose3, bundle_landmarks: List[gtsam.Point3]):
     """
     Convert the points to world coordinates, from already "world" coordinates, but they are according to the first
-    camera of the bundle
+    camera of the bundle.
+    All the landmarks are transformed at once (R @ p + t), as an (N, 3) array.
     """
-    global_landmarks = []
-    for landmark in bundle_landmarks:
-        global_landmark = first_cam.transformFrom(landmark)
-        global_landmarks.append(global_landmark)
-
-    return global_landmarks
+    landmarks = np.asarray(bundle_landmarks, dtype=np.float64).reshape(-1, 3)
+    return landmarks @ first_cam.rotation().matrix().T + first_cam.translation()
 
 
 def convert_rel_landmarks_to_global(rel_cameras, rel_landmarks):
@@ -51,19 +51,19 @@ def convert_rel_landmarks_to_global(rel_cameras, rel_landmarks):
     convert the points to world coordinates, from already "world" coordinates, but they are according to the first
     camera of every bundle
     """
-    global_landmarks = []
-    for bundle_camera, bundle_landmarks in zip(rel_cameras, rel_landmarks):
-        bundle_global_landmarks = convert_from_bundel_to_world(bundle_camera, bundle_landmarks)
-        global_landmarks += bundle_global_landmarks
-
-    return np.array(global_landmarks)
+    global_landmarks = [convert_from_bundel_to_world(bundle_camera, bundle_landmarks)
+                        for bundle_camera, bundle_landmarks in zip(rel_cameras, rel_landmarks)]
+    return np.concatenate([np.empty((0, 3))] + global_landmarks)
 
 
 def get_trajectory_from_gtsam_poses(poses: List[gtsam.Pose3]):
-    trajectory = []
-    for pose in poses:
-        trajectory.append(pose.translation())
-    return np.array(trajectory)
+    """
+    Returns the (N, 3) locations of the given poses, filled into a preallocated array.
+    """
+    trajectory = np.empty((len(poses), 3))
+    for i, pose in enumerate(poses):
+        trajectory[i] = pose.translation()
+    return trajectory
 
 
 def calc_relative_camera_pos(ext_camera_mat):
@@ -79,9 +79,7 @@ def calculate_camera_trajectory(relative_T_arr):
     Calculate the camera trajectory according to the relative position of
      each camera.
     """
-    trajectory = []
-    for T in relative_T_arr:
-        trajectory.append(calc_relative_camera_pos(T))
-    return np.array(trajectory)
+    relative_T_arr = np.asarray(relative_T_arr)
+    return -np.einsum('nji,nj->ni', relative_T_arr[:, :, :3], relative_T_arr[:, :, 3])
 
 
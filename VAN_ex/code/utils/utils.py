@@ -11,13 +11,17 @@ import gtsam
 from mpl_toolkits.mplot3d import Axes3D
 import VAN_ex.code.Ex2.ex2 as ex2_utils
 # from VAN_ex.code.Ex4.ex4 import TracksDB, Track
-from VAN_ex.code.utils.projection_utils import calculate_camera_trajectory
+from VAN_ex.code.utils.projection_utils import calculate_camera_trajectory, get_trajectory_from_gtsam_poses, \
+    convert_from_bundel_to_world
 
 DATA_PATH = os.path.join('../..', 'dataset', 'sequences', '05')
 N_FEATURES = 500
 RATIO = 0.6
 DIFF = 2
 ALGORITHM = cv2.AKAZE_create()
+# Matchers are stateless between calls (descriptors are passed explicitly), so create them once
+KNN_MATCHER = cv2.BFMatcher(normType=cv2.NORM_HAMMING)
+CROSS_CHECK_MATCHER = cv2.BFMatcher(normType=cv2.NORM_HAMMING, crossCheck=True)
 old_k, m1, m2 = ex2_utils.read_cameras()
 
 
@@ -110,15 +114,13 @@ def match_significance(desc1, desc2):
     :param desc2: List of descriptors from Image2.
     :return: List of matches found.
     """
-    brute_force = cv2.BFMatcher(normType=cv2.NORM_HAMMING)
-    matches = brute_force.knnMatch(desc1, desc2, k=2)
+    matches = KNN_MATCHER.knnMatch(desc1, desc2, k=2)
     matches, _ = significance_test(matches, RATIO)
     return matches
 
 
 def match_bf(desc1, desc2):
-    brute_force = cv2.BFMatcher(normType=cv2.NORM_HAMMING, crossCheck=True)
-    matches = brute_force.match(desc1, desc2)
+    matches = CROSS_CHECK_MATCHER.match(desc1, desc2)
     return matches
 
 
@@ -241,7 +243,8 @@ def matches_to_pts_knn(matches, left_kps, right_kps):
     for match in matches:
         left_inliers.append(left_kps[match[0].queryIdx].pt)
         right_inliers.append(right_kps[match[0].trainIdx].pt)
-    return np.array(left_inliers), np.array(right_inliers)
+    # OpenCV detects key-points in float32, so storing them at that width loses nothing
+    return np.array(left_inliers, dtype=np.float32), np.array(right_inliers, dtype=np.float32)
 
 def matches_to_pts_bf(matches, left_kps, right_kps):
     """
@@ -251,7 +254,8 @@ def matches_to_pts_bf(matches, left_kps, right_kps):
     for match in matches:
         left_inliers.append(left_kps[match.queryIdx].pt)
         right_inliers.append(right_kps[match.trainIdx].pt)
-    return np.array(left_inliers), np.array(right_inliers)
+    # OpenCV detects key-points in float32, so storing them at that width loses nothing
+    return np.array(left_inliers, dtype=np.float32), np.array(right_inliers, dtype=np.float32)
 
 def display_point_cloud(first_cloud, second_claud, txt, elev=60, azim=10):
     """
@@ -356,6 +360,22 @@ def create_gtsam_K():
     return K
 
 
+def relative_covariance(marginals, keys):
+    """
+    Calculate the covariance of the relative motion between two poses, i.e. the covariance of keys[1]
+     conditioned on keys[0]. It is the Schur complement of the keys[0] block in their joint marginal
+     covariance: cov_kk - cov_k0 @ cov_00^-1 @ cov_0k, which only needs a single 6x6 solve.
+    :param marginals: gtsam.Marginals of the optimized graph.
+    :param keys: gtsam.KeyVector of the two pose keys.
+    :return: 6x6 relative covariance matrix.
+    """
+    joint_cov = marginals.jointMarginalCovariance(keys)
+    cov_00 = joint_cov.at(keys[0], keys[0])
+    cov_0k = joint_cov.at(keys[0], keys[1])
+    cov_kk = joint_cov.at(keys[1], keys[1])
+    return cov_kk - cov_0k.T @ np.linalg.solve(cov_00, cov_0k)
+
+
 def gtsam_plot_trajectory_fixed(fignum: int, values, scale: float = 1, marginals=None, title: str = "Plot Trajectory",
                                 axis_labels=("X axis", "Y axis", "Z axis"), ) -> None:
     """
@@ -406,14 +426,13 @@ def relative_to_absolute_poses(cameras, points):
     """
     Convert relative poses to absolute poses.
     """
-    abs_points, abs_cameras = [], [cameras[0]]
+    abs_points, abs_cameras = [np.empty((0, 3))], [cameras[0]]
 
     for bundle_camera, bundle_points in zip(cameras, points):
         abs_cameras.append(abs_cameras[0].compose(bundle_camera))
-        bundle_abs_points = [abs_cameras[-1].transformFrom(point) for point in bundle_points]
-        abs_points.extend(bundle_abs_points)
+        abs_points.append(convert_from_bundel_to_world(abs_cameras[-1], bundle_points))
 
-    return np.array(abs_cameras), np.array(abs_points)
+    return np.array(abs_cameras), np.concatenate(abs_points)
 
 
 def gtsam_left_cameras_trajectory(relative_T_arr):
@@ -422,10 +441,7 @@ def gtsam_left_cameras_trajectory(relative_T_arr):
     :param T_arr: relative to first camera transformations array
     :return: numpy array with dimension num T_arr X 3
     """
-    global_cam_loc = []
-    for t in relative_T_arr:
-        global_cam_loc.append(t.translation())
-    return np.array(global_cam_loc)
+    return get_trajectory_from_gtsam_poses(relative_T_arr)
 
 
 def gtsam_plot_point3_fixed(fignum: int, point: gtsam.Point3, linespec: str, P: np.ndarray = None,
@@ -550,8 +566,7 @@ def calculate_euclidian_dist(abs_cameras, ground_truth_cameras):
     and the ground truth camera positions
     """
     pts_sub = abs_cameras - ground_truth_cameras
-    sum_of_squared_diffs = np.linalg.norm(pts_sub, axis=1)
-    return sum_of_squared_diffs
+    return np.sqrt(np.einsum('ij,ij->i', pts_sub, pts_sub))
 
 
 def rotation_matrix_to_euler_angles(R):